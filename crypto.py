@@ -1,79 +1,183 @@
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives.padding import PKCS7
-from cryptography.hazmat import backends
+import typing
+import functools
+from cryptography.hazmat.primitives.ciphers import Cipher, CipherContext, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
 import protocol
 
+# Every cipher here goes through cryptography, which wraps OpenSSL's EVP interface and already
+# dispatches to AES-NI (plus PCLMULQDQ for GCM) when the CPU supports it. cryptography is a hard
+# requirement, so other AES packages (pyaesni, cryptg, pyaes) aren't tried as fallbacks:
+# none of them covers all the enabled modes, and pyaes is pure Python.
+
+# Dictionary that maps supported and enabled algorithms names to it's (class, key size) pairs.
+# The lib cryptography doesn't differentiate algorithms based on the key size,
+# it's just a matter of passing the desired key size to it.
+# Built once at import time instead of on every cipher construction.
+_ENABLED_ALGORITHMS = {
+    'AES128':    (algorithms.AES,       128),
+    'AES192':    (algorithms.AES,       192),
+    'AES256':    (algorithms.AES,       256),
+    'DES':       (algorithms.TripleDES, 64),  # as k1, k2, and k3 are the same, it becomes a simple DES (https://en.wikipedia.org/wiki/Triple_DES#Keying_options)
+    '3DES-EDE2': (algorithms.TripleDES, 128),
+    '3DES-EDE3': (algorithms.TripleDES, 192),
+    'CHACHA20':  (None,                 256),  # stream cipher, only enabled with the POLY1305 AEAD mode
+}
+
+# Dictionary that maps supported and enabled modes names to it's constructors (not instances,
+# the IV is only known once negotiated), so binding an IV just has to call them with it.
+_ENABLED_MODE_CTORS = {
+    'ECB': lambda iv: modes.ECB(),  # ECB mode is the only one which doesn't take any arguments
+    'CBC': modes.CBC,
+    # 'CFB1': None,
+    'CFB8': modes.CFB8,
+    # 'CFB64': None,
+    # 'CFB128': None,
+    'CTR': modes.CTR,  # preferred mode: C_i = P_i XOR AES_K(IV + i), so blocks are independent (parallelizable) and no padding is needed
+}
+
+# Dictionary that maps supported and enabled AEAD modes names to it's (class, allowed algorithms) pairs.
+# These modes encrypt and authenticate in a single pass and never need padding.
+# They take a 12 bytes nonce (the first 12 bytes of the IV) and append a 16 bytes tag to the ciphertext.
+_ENABLED_AEAD_MODES = {
+    'GCM':      (AESGCM,           ('AES128', 'AES192', 'AES256')),
+    'POLY1305': (ChaCha20Poly1305, ('CHACHA20',)),  # fast without AES-NI
+}
+
+
+"""
+Builds the block cipher algorithm object for a key, refusing the algorithms only enabled
+with an AEAD mode and keys of the wrong size. Cached per (algorithm, key) pair.
 """
-Builds a Cipher object used by both encryption and decryption functions.
-"""
-def build_cipher(key: bytes, iv: bytes, alg: str, mode: str) -> Cipher:
-    # Dictionary that maps supported and enabled algorithms names to it's classes and key sizes.
-    # The lib cryptography doesn't differentiate algorithms based on the key size,
-    # it's just a matter of passing the desired key size to it.
-    enabled_algorithms = {
-        'AES128':    {'class': algorithms.AES,       'key_size': 128},
-        'AES192':    {'class': algorithms.AES,       'key_size': 192},
-        'AES256':    {'class': algorithms.AES,       'key_size': 256},
-        'DES':       {'class': algorithms.TripleDES, 'key_size': 64},  # as k1, k2, and k3 are the same, it becomes a simple DES (https://en.wikipedia.org/wiki/Triple_DES#Keying_options)
-        '3DES-EDE2': {'class': algorithms.TripleDES, 'key_size': 128},
-        '3DES-EDE3': {'class': algorithms.TripleDES, 'key_size': 192},
-    }
-
-    # Dictionary that maps supported and enabled modes names to it's classes.
-    enabled_modes = {
-        'ECB': modes.ECB(),  # ECB mode is the only one which doesn't take any arguments
-        'CBC': modes.CBC(iv),
-        # 'CFB1': None,
-        'CFB8': modes.CFB8(iv),
-        # 'CFB64': None,
-        # 'CFB128': None,
-        'CTR': modes.CTR(iv),
-    }
-
-    # Gets the algorithm and mode.
-    alg_select = enabled_algorithms[alg]
-    mode_select = enabled_modes[mode]
+@functools.lru_cache(maxsize=128)
+def _cached_algorithm(alg: str, key: bytes) -> algorithms.CipherAlgorithm:
+    alg_class, key_size = _ENABLED_ALGORITHMS[alg]
+
+    # Algorithms only enabled through an AEAD mode can't be used with the block modes.
+    if alg_class is None:
+        print('algorithm not supported by this mode')
+        raise protocol.ErrorCodes(protocol.ErrorCodes.NotSupportedParams)
 
     # Check if the key size is the right one as cryptography lib doesn't differentiate it.
-    try:
-        alg_obj = alg_select['class'](key)
-        assert alg_obj.key_size == alg_select['key_size']
-    except:
+    # It's compared straight from the key length: TripleDES expands 64 and 128 bits keys
+    # to 192 bits, so its key_size attribute never matches DES and 3DES-EDE2.
+    if len(key) * 8 != key_size:
         print('wrong key size')
         raise protocol.ErrorCodes(protocol.ErrorCodes.NotSupportedParams)
 
-    # Creates the Cipher object with a default cryptography backend.
-    return Cipher(alg_obj, mode_select, backend=backends.default_backend())
+    return alg_class(key)
 
 
 """
-Uses a Cipher object to encrypt a data.
+Builds the AEAD object for a key, refusing algorithms the AEAD mode isn't tied to
+and keys of the wrong size. Cached per (algorithm, mode, key).
 """
-def encrypt(data: bytes, key: bytes, iv: bytes, alg: str, mode: str, pkcs5: bool) -> bytes:
-    # Pad a data with PKCS5
-    if pkcs5:
-        data = padder_pkcs5(data)
+@functools.lru_cache(maxsize=128)
+def _cached_aead(alg: str, mode: str, key: bytes) -> typing.Union[AESGCM, ChaCha20Poly1305]:
+    aead_class, aead_algorithms = _ENABLED_AEAD_MODES[mode]
+
+    # Each AEAD mode is tied to its own algorithms.
+    if alg not in aead_algorithms:
+        print('algorithm not supported by this mode')
+        raise protocol.ErrorCodes(protocol.ErrorCodes.NotSupportedParams)
 
-    cipher = build_cipher(key, iv, alg, mode)
-    encryptor = cipher.encryptor()
+    if len(key) * 8 != _ENABLED_ALGORITHMS[alg][1]:
+        print('wrong key size')
+        raise protocol.ErrorCodes(protocol.ErrorCodes.NotSupportedParams)
 
-    return encryptor.update(data) + encryptor.finalize()
+    return aead_class(key)
 
 
 """
-Uses a Cipher object to decrypt a data.
+Runs the data through an encryption or decryption context and finalizes it.
 """
-def decrypt(data: bytes, key: bytes, iv: bytes, alg: str, mode: str, pkcs5: bool) -> bytes:
-    cipher = build_cipher(key, iv, alg, mode)
-    decryptor = cipher.decryptor()
+def _process(context: CipherContext, data: bytes) -> bytes:
+    # finalize is empty for stream modes and for already padded data,
+    # so the output is only copied into a new buffer when there's a tail.
+    ret = context.update(data)
+    tail = context.finalize()
+
+    return ret + tail if tail else ret
+
+
+# Signature of the encrypt and decrypt functions bound to an IV: data -> processed data
+CryptFunction = typing.Callable[[bytes], bytes]
+
+# Signature of the functions returned by specialize: IV -> (encrypt, decrypt)
+BindFunction = typing.Callable[[bytes], typing.Tuple[CryptFunction, CryptFunction]]
+
+
+"""
+Resolves an algorithm, mode and padding option for a key once, returning a function that binds
+them to an IV, giving the encrypt and decrypt functions. The key size is checked here and the
+Cipher object is built when binding, so processing a message doesn't look anything up by name.
+"""
+@functools.lru_cache(maxsize=128)
+def specialize(key: bytes, alg: str, mode: str, pkcs5: bool) -> BindFunction:
+    # AEAD modes don't use a Cipher object nor padding.
+    if mode in _ENABLED_AEAD_MODES:
+        aead = _cached_aead(alg, mode, key)
+
+        def bind_aead(iv: bytes) -> typing.Tuple[CryptFunction, CryptFunction]:
+            nonce = iv[:12]
+
+            def aead_encrypt(data: bytes) -> bytes:
+                return aead.encrypt(nonce, data, None)
 
-    ret = decryptor.update(data) + decryptor.finalize()
+            def aead_decrypt(data: bytes) -> bytes:
+                # Raises InvalidTag if the data was tampered.
+                return aead.decrypt(nonce, data, None)
 
-    # Unpad a PKCS5 padded data.
-    if pkcs5:
-        ret = unpadder_pkcs5(ret)
+            return aead_encrypt, aead_decrypt
 
-    return ret
+        return bind_aead
+
+    alg_obj = _cached_algorithm(alg, key)
+    mode_ctor = _ENABLED_MODE_CTORS[mode]
+
+    # CTR works as a stream cipher, so padding is never needed.
+    pad = pkcs5 and mode != 'CTR'
+
+    # The IV is always 16 bytes on the wire, but the modes take one as long as the block,
+    # which is only 8 bytes for (Triple)DES.
+    iv_size = alg_obj.block_size // 8
+
+    def bind_block(iv: bytes) -> typing.Tuple[CryptFunction, CryptFunction]:
+        # Contexts can only be used once, but the Cipher object creates one for each message.
+        # cryptography 3.1+ picks its (only) OpenSSL backend by itself.
+        cipher = Cipher(alg_obj, mode_ctor(iv[:iv_size]))
+
+        def block_encrypt(data: bytes) -> bytes:
+            # Pad a data with PKCS5
+            if pad:
+                data = padder_pkcs5(data)
+
+            return _process(cipher.encryptor(), data)
+
+        def block_decrypt(data: bytes) -> bytes:
+            ret = _process(cipher.decryptor(), data)
+
+            # Unpad a PKCS5 padded data.
+            return unpadder_pkcs5(ret) if pad else ret
+
+        return block_encrypt, block_decrypt
+
+    return bind_block
+
+
+"""
+Uses a Cipher object to encrypt a data.
+"""
+def encrypt(data: bytes, key: bytes, iv: bytes, alg: str, mode: str, pkcs5: bool) -> bytes:
+    encrypt_fn, _ = specialize(key, alg, mode, pkcs5)(iv)
+    return encrypt_fn(data)
+
+
+"""
+Uses a Cipher object to decrypt a data.
+"""
+def decrypt(data: bytes, key: bytes, iv: bytes, alg: str, mode: str, pkcs5: bool) -> bytes:
+    _, decrypt_fn = specialize(key, alg, mode, pkcs5)(iv)
+    return decrypt_fn(data)
 
 
 """
@@ -81,9 +185,9 @@ PKCS7 is a generalization of PKCS5, allowing a wide range of block sizes,
 then we can just use it with block size 128 bits.
 """
 def padder_pkcs5(data: bytes) -> bytes:
-    # Pads with PKCS7 using 128 bits block size.
-    p = PKCS7(128).padder()
-    return p.update(data) + p.finalize()
+    # Pads with PKCS7 using 128 bits block size: appends pad bytes, each one worth pad.
+    pad = 16 - (len(data) & 0xF)
+    return data + bytes((pad,)) * pad
 
 
 """
@@ -91,7 +195,12 @@ PKCS7 is a generalization of PKCS5, allowing a wide range of block sizes,
 then we can just use it with block size 128 bits.
 """
 def unpadder_pkcs5(data: bytes) -> bytes:
-    # Unpads a PKCS7-padded data.
-    p = PKCS7(128).unpadder()
-    return p.update(data) + p.finalize()
+    # Unpads a PKCS7-padded data, validating the padding bytes.
+    if not data or len(data) & 0xF:
+        raise ValueError('invalid padding bytes')
+
+    pad = data[-1]
+    if not 1 <= pad <= 16 or data[-pad:] != bytes((pad,)) * pad:
+        raise ValueError('invalid padding bytes')
 
+    return data[:-pad]
@@ -12,6 +12,9 @@ import networking
 --client --key "chave 1 de teste" --pkcs5
 --client --key "chave 1 de teste" --algorithm=AES256,CFB128 --pkcs5
 --client --key "chave 1 de teste" --algorithm=3DES-EDE2,CFB128
+--client --key "chave 1 de teste" --algorithm=AES128,GCM
+--client --key "chave 1 de teste" --algorithm=AES128
+--client --key "6368617665203120646520746573746563686176652031206465207465737465" --key-type=hex --algorithm=CHACHA20,POLY1305
 --server --key "chave 1 de teste"
 --server --key "chave 1 de teste" --addr=10.0.0.20,8080
 '''
@@ -49,8 +52,12 @@ def main():
                         default='127.0.0.1,50000',
                         required=False)
     parser.add_argument('--algorithm',
-                        help='Define algorithm and mode to be used (delimited by a comma). An error is thrown if it isn\'t supported.',
-                        default='AES128,ECB',
+                        help='Define algorithm and mode to be used (delimited by a comma). An error is thrown if it isn\'t supported. '
+                             'CTR is the preferred mode: it is parallelizable and doesn\'t need padding, '
+                             'and it\'s used when only the algorithm is given (CBC for DES and 3DES, POLY1305 for CHACHA20). '
+                             'GCM also authenticates the message (AES only). '
+                             'CHACHA20,POLY1305 is the authenticated alternative for machines without AES-NI (256 bits key).',
+                        default='AES128,CTR',
                         required=False)
     parser.add_argument('--pkcs5',
                         help='Enable PKCS5 padding mode.',
@@ -1,5 +1,9 @@
 import typing
 import socket
+import struct
+import selectors
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from sys import stdin
 import protocol
 
@@ -8,105 +12,237 @@ Address = typing.Tuple[str, int]
 
 class Connection:
     """
-    Both methods are static, that way we do not need to initialize any variable into our class.
+    All methods are static, that way we do not need to initialize any variable into our class.
     With Static Methods both functions become linked to the class, not the object.
+    Receiving is buffered per connection, so it's done through a Receiver instead.
     """
 
     @staticmethod
     def send(conn: socket.socket, msg: bytes) -> None:
-        # Total sent bytes counter, used to determine
-        # whether the message has been sent successfully or not
-        total_sent: int = 0
+        # .sendall is a socket's function. It keeps sending the message until there's none to send,
+        # without copying the remaining bytes of the message on every partial send.
+        # An OSError is raised if the connection breaks.
+        conn.sendall(msg)
 
-        # Keeps sending message bytes until there's none to send
-        while total_sent < len(msg):
-            # .send is a socket's function. Used to send data through a TCP based socket.
-            # [init:] = it skips init bytes of the message
-            bytes_sent: int = conn.send(msg[total_sent:])
+    @staticmethod
+    def send_vec(conn: socket.socket, buffers: typing.Sequence[bytes]) -> None:
+        # Without .sendmsg (e.g. on Windows) the buffers are joined and sent at once
+        if not hasattr(conn, 'sendmsg'):
+            conn.sendall(b''.join(buffers))
+            return
+
+        # Views over the buffers still to be sent. Empty buffers are skipped, as
+        # sending nothing can't be told apart from a broken connection
+        views = [memoryview(buf) for buf in buffers if len(buf)]
+
+        # Keeps sending the buffers until there's none to send
+        while views:
+            # .sendmsg is a socket's function. It gathers all the buffers in a single
+            # system call (writev), so they don't need to be copied into one first.
+            bytes_sent: int = conn.sendmsg(views)
 
             # If 0 bytes was sent, then there's a problem
             if bytes_sent == 0:
                 raise RuntimeError('socket connection broken')
-            total_sent += bytes_sent
 
-    @staticmethod
-    def receive(conn: socket.socket, msg_size: int) -> bytes:
-        # Variable to store the message. It's initialized to an empty byte string.
-        msg: bytes = b''
+            # Drops the fully sent buffers and skips the sent part of the next one
+            while views and bytes_sent >= len(views[0]):
+                bytes_sent -= len(views.pop(0))
+            if bytes_sent:
+                views[0] = views[0][bytes_sent:]
 
-        # Keeps receiving expected message bytes until there's none to receive
-        while len(msg) < msg_size:
 
-            # .recv is a socket's function. Used to recovery data through a TCP based socket.
-            # If the message has more than 2048, it's broken into parts
-            chunk = conn.recv(min(msg_size - len(msg), 2048))
+class Receiver:
+    """
+    Buffered receiving side of a connection. Every system call reads as much as is available
+    (up to the buffer size), so a header and its payload usually arrive with a single recv_into.
+    Bytes read past the current message are kept for the next one, so all the receives
+    of a connection must go through the same Receiver.
+    """
+    def __init__(self, conn: socket.socket, buffer_size: int = 2048) -> None:
+        self.conn: socket.socket = conn
+        self.buffer_size: int = buffer_size
+        self._buf: bytearray = bytearray(buffer_size)
+        self._start: int = 0  # First byte not consumed yet
+        self._end: int = 0  # End of the received bytes
 
-            # If 0 bytes was received, then there's a problem
-            if chunk == b'':
-                raise RuntimeError('socket connection broken')
-            msg += chunk
+    """
+    Makes sure at least msg_size bytes not consumed yet are in the buffer.
+    """
+    def _fill(self, msg_size: int) -> None:
+        available = self._end - self._start
+        if available >= msg_size:
+            return
+
+        # Relaxes a buffer grown by a previous large message back to the default size,
+        # once it's empty and the next message fits in the default size
+        if not available and msg_size <= self.buffer_size < len(self._buf):
+            self._buf = bytearray(self.buffer_size)
+
+        # Moves the bytes not consumed yet to the beginning of the buffer,
+        # or to a new bigger one if the message doesn't fit at all
+        if msg_size > len(self._buf):
+            buf = bytearray(msg_size)
+            buf[:available] = self._buf[self._start:self._end]
+            self._buf = buf
+        elif self._start:
+            self._buf[:available] = self._buf[self._start:self._end]
+        self._start = 0
+        self._end = available
+
+        # Keeps receiving until the message is complete, taking whatever else fits in the buffer
+        with memoryview(self._buf) as view:
+            while self._end < msg_size:
+                chunk_size = self.conn.recv_into(view[self._end:])
+
+                # If 0 bytes was received, then there's a problem
+                if chunk_size == 0:
+                    raise RuntimeError('socket connection broken')
+                self._end += chunk_size
+
+    """
+    Receives exactly msg_size bytes.
+    """
+    def receive(self, msg_size: int) -> bytes:
+        self._fill(msg_size)
+
+        with memoryview(self._buf) as view:
+            msg = bytes(view[self._start:self._start + msg_size])
+        self._start += msg_size
 
         return msg
 
+    """
+    Receives exactly msg_size bytes, returning a view over the buffer instead of a copy.
+    The view is only valid until the next receive, and must be released before it.
+    """
+    def receive_view(self, msg_size: int) -> memoryview:
+        self._fill(msg_size)
+
+        view = memoryview(self._buf)[self._start:self._start + msg_size]
+        self._start += msg_size
+
+        return view
+
+    """
+    Receives a header whose last field is the payload size, followed by that payload.
+    Returns the header fields and the payload.
+    """
+    def receive_framed(self, header: struct.Struct) -> typing.Tuple[tuple, bytes]:
+        fields = header.unpack(self.receive(header.size))
+        payload = self.receive(fields[-1])
+
+        return fields, payload
+
 
 class Server:
     """
     By default, the server will be created into a given address, using the TCP protocol.
     The shared key used by the cryptography is also passed.
+    Accepted connections are handled concurrently by a pool of worker threads.
+    A connection is dropped if it stays idle for longer than timeout seconds, and new connections
+    are refused while max_connections are already being handled or waiting for a worker.
     """
-    def __init__(self, addr: Address, key: bytes) -> None:
+    def __init__(self, addr: Address, key: bytes, workers: int = 8, backlog: int = 128,
+                 timeout: float = 10.0, max_connections: int = 64) -> None:
         self.addr: Address = addr
         self.key: bytes = key
+        self.workers: int = workers
+        self.backlog: int = backlog
+        self.timeout: float = timeout
+        self.max_connections: int = max_connections
         self.sock: socket.socket = None
-        self.conn: socket.socket = None
-        self.source_id: int = None
-        self.dest_id: int = None
-        self._message: bytes = None
+        self._pool: ThreadPoolExecutor = None
+        self._connections: typing.Set[socket.socket] = set()
+        self._connections_lock = threading.Lock()
 
     """
     Creates a socket with the AF_INET protocol (provides IPv4 support) and
     the TCP protocol (SOCK_STREAM), then starts a server.
+    create_server sets SO_REUSEADDR (on POSIX) and listens with the given backlog.
+    The socket is non-blocking, as accepting is driven by a selector.
     """
     def start(self) -> None:
-        self.sock = socket.create_server(address=self.addr, family=socket.AF_INET)
+        self.sock = socket.create_server(address=self.addr, family=socket.AF_INET, backlog=self.backlog)
+        self.sock.setblocking(False)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers)
 
     """
-    Accepts a connection and returns the client address. 
+    Accepts connections until interrupted, handing each one with the client address
+    to handler on the worker pool. The connection is closed once handler returns.
     """
-    def wait_for_connection(self) -> Address:
-        self.conn, client_address = self.sock.accept()
-
-        return client_address
+    def serve(self, handler: typing.Callable[[socket.socket, Address], None]) -> None:
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.sock, selectors.EVENT_READ)
+
+            while True:
+                for _ in selector.select():
+                    try:
+                        conn, client_address = self.sock.accept()
+                    except (BlockingIOError, ConnectionAbortedError):
+                        # The client went away before being accepted
+                        continue
+
+                    with self._connections_lock:
+                        if len(self._connections) >= self.max_connections:
+                            # Too many connections handled or waiting for a worker, refuse this one
+                            conn.close()
+                            continue
+                        self._connections.add(conn)
+
+                    # The timeout also makes the socket blocking, as whether the accepted socket
+                    # inherits non-blocking mode is OS-dependent. An idle client can only hold a worker
+                    # for that long. Messages are small request/response exchanges, so Nagle's algorithm is disabled.
+                    conn.settimeout(self.timeout)
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+                    self._pool.submit(self._handle, handler, conn, client_address)
 
     """
-    Receives and stores all the data.
+    Runs handler for a connection, then closes and forgets it.
     """
-    def receive(self) -> None:
-        receive = protocol.Receive(self.conn, self.key)
-        receive.process()
-        self.source_id: int = receive.source_id
-        self.dest_id: int = receive.dest_id
-        self._message: bytes = receive.message
+    def _handle(self, handler: typing.Callable[[socket.socket, Address], None], conn: socket.socket, client_address: Address) -> None:
+        try:
+            handler(conn, client_address)
+        finally:
+            with self._connections_lock:
+                self._connections.discard(conn)
+            conn.close()
 
     """
-    Message getter
+    Receives all the data from a connection and returns it.
     """
-    @property
-    def message(self) -> bytes:
-        if self._message is None:
-            raise RuntimeError('message not ready')
-        return self._message
+    def receive(self, conn: socket.socket) -> 'protocol.Receive':
+        receive = protocol.Receive(conn, self.key)
+        receive.process()
+
+        return receive
 
     """
-    Closes the socket and the connection to the client.
+    Closes the socket and the connections to the clients still being handled.
     """
     def close(self) -> None:
-        if self.conn:
-            self.conn.close()
-
         if self.sock:
             self.sock.close()
 
+        # Shutting down wakes up workers blocked on a receive, so they can finish
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+        # Waits for the running workers, which close their connections. The connections still
+        # waiting for a worker are cancelled, so they're closed here as no worker will.
+        if self._pool:
+            self._pool.shutdown(cancel_futures=True)
+
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
 
 class Client:
     """
@@ -127,6 +263,7 @@ class Client:
     """
     def connect(self) -> None:
         self.conn = socket.create_connection(address=self.addr)
+        self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     """
     Sends a message to the client in a given connection, from a source id,
@@ -145,7 +282,7 @@ class Client:
 
 
 """
-Primary function used to open the server and receive a message.
+Primary function used to open the server and receive messages.
 """
 def open_server(addr: Address, key: bytes) -> None:
     # Creates a server listening in addr, and with a shared key
@@ -158,23 +295,25 @@ def open_server(addr: Address, key: bytes) -> None:
         print(f'couldn\'t start server on {addr}.')
         return
 
-    try:
-        print('waiting for a connection... press Ctrl + C to interrupt')
-        client_addr = s.wait_for_connection()  # Waits for a connection to establish
+    # Handles a single client, called concurrently by the server workers
+    def handle(conn: socket.socket, client_addr: Address) -> None:
         print(f'connection accepted from {client_addr}')
 
-        # Starts receiving the message
-        s.receive()
+        try:
+            # Receives the message and gets source id, destination id, and the message itself
+            receive = s.receive(conn)
+            source = receive.source_id
+            dest = receive.dest_id
+            message = receive.message
+            print(f'>>> (FROM: {source}; TO: {dest})\n>>>MESSAGE START\n{message.decode("utf-8")}\n>>> MESSAGE END')
+        except Exception as e:
+            print(f'error: {e}')
 
-        # Gets source id, destination id, and the message itself
-        source = s.source_id
-        dest = s.dest_id
-        message = s.message
-        print(f'>>> (FROM: {source}; TO: {dest})\n>>>MESSAGE START\n{message.decode("utf-8")}\n>>> MESSAGE END')
+    try:
+        print('waiting for connections... press Ctrl + C to interrupt')
+        s.serve(handle)  # Accepts connections until interrupted
     except KeyboardInterrupt:
-        s.close()
         print('interrupted')
-        return
     except Exception as e:
         print(f'error: {e}')
 
@@ -204,13 +343,9 @@ def open_client(addr: Address, source_id: int, dest_id: int, key: bytes, algorit
     try:
         print('type your message (reading until EOF, Ctrl + D in some terminals)... press Ctrl + C to interrupt')
 
-        # Reads stdin. Strip whitespaces at the beginning and the end fo the string to disallow empty messages
-        # which can lead to 0 bytes being sent and breaking the socket
-        terminal_input = ''
-        while terminal_input.strip() == '':
-            terminal_input = stdin.read()
-            if terminal_input.strip() == '':
-                print('message cannot be empty')
+        # Reads stdin as raw bytes, so it doesn't need to be decoded and encoded back before sending.
+        # It's read until EOF, so there's nothing left to read if the message is empty.
+        terminal_input = stdin.buffer.read()
 
         print('\n')
     except KeyboardInterrupt:
@@ -218,9 +353,16 @@ def open_client(addr: Address, source_id: int, dest_id: int, key: bytes, algorit
         print('interrupted')
         return
 
+    # Strip whitespaces at the beginning and the end fo the message to disallow empty messages
+    # which can lead to 0 bytes being sent and breaking the socket
+    if not terminal_input.strip():
+        c.close()
+        print('message cannot be empty')
+        return
+
     try:
         # Sends to the server the read message
-        c.send(terminal_input.encode('utf-8'))
+        c.send(terminal_input)
     except Exception as e:
         print(f'some error occurred: {e}')
 
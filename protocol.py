@@ -1,17 +1,24 @@
 import typing
 import socket
 import struct
+import hmac
 import networking
 import os
 import crypto
 
+# Headers are parsed with plain integer shifts and masks over these layouts. A JIT (e.g. Numba)
+# isn't used: its dispatch overhead alone is larger than parsing a few bytes here, and the
+# only heavy work per message, the cryptography, already runs in OpenSSL.
 
-"""
-Convert that byte to an 8 bit string.
-"""
-def byte_to_bitstring(data: bytes) -> str:
-    assert len(data) == 1, 'it only works with one byte at time'
-    return '{:0>8}'.format(bin(int.from_bytes(data, 'big')).lstrip('0b'))
+# Precompiled message layouts, so the format strings aren't parsed on every message.
+# B unsigned char (1 byte)
+# H unsigned short (2 bytes)
+_PARREQ = struct.Struct('>BHHBB')
+_BYTE = struct.Struct('>B')
+_DADOS_HDR = struct.Struct('>BH')
+
+# An IV made of zero bytes, which is refused
+_NULL_IV = bytes(16)
 
 
 class ErrorCodes(Exception):
@@ -28,24 +35,25 @@ class ErrorCodes(Exception):
     NullIV = 5
     DataError = 6
 
-    # Maps back the id to the error string
-    error_types = {
-        0: 'OK',
-        1: 'NotSupportedParams',
-        2: 'Internal',
-        3: 'KeyNotShared',
-        4: 'UnexpectedType',
-        5: 'NullIV',
-        6: 'DataError',
-    }
+    # Maps back the id to the error string. The ids are contiguous, so the id is the index
+    error_types = (
+        'OK',                  # 0
+        'NotSupportedParams',  # 1
+        'Internal',            # 2
+        'KeyNotShared',        # 3
+        'UnexpectedType',      # 4
+        'NullIV',              # 5
+        'DataError',           # 6
+    )
 
     def __init__(self, code: int) -> None:
         # Thrown an error error if the error code isn't found.
-        if code not in self.error_types:
+        if not 0 <= code < len(self.error_types):
             raise KeyError('error code not found')
 
         self._code: int = code
-        super(ErrorCodes, self).__init__(self.__repr__())
+        # The code itself is the exception argument, the message is only formatted when it's shown
+        super(ErrorCodes, self).__init__(code)
 
     """
     Error code getter
@@ -61,11 +69,48 @@ class ErrorCodes(Exception):
         return f'Error.{self.error_types[self._code]}'
 
     """
-    Operator overloading to enable comparisons as error == ErrorCodes.OK
+    Same as the representation, as it's what is printed when the error is shown.
+    """
+    def __str__(self) -> str:
+        return self.__repr__()
+
+    """
+    Operator overloading to enable comparisons as error == ErrorCodes.OK,
+    or between two errors.
     """
-    def __eq__(self, other: int) -> bool:
+    def __eq__(self, other: typing.Union[int, 'ErrorCodes']) -> bool:
+        if isinstance(other, ErrorCodes):
+            return self._code == other._code
         return self._code == other
 
+    """
+    Hashes as the code, consistent with comparing equal to it, so errors can be set members and dict keys.
+    """
+    def __hash__(self) -> int:
+        return hash(self._code)
+
+    """
+    Returns the shared instance of an error code, for codes that are only passed around and compared.
+    Raised errors are still new instances, as a shared one would keep piling up tracebacks.
+    """
+    @classmethod
+    def get(cls, code: int) -> 'ErrorCodes':
+        instance = cls._instances.get(code)
+        if instance is None:
+            raise KeyError('error code not found')
+
+        return instance
+
+
+# One shared instance per error code, built once
+ErrorCodes._instances = {code: ErrorCodes(code) for code in range(len(ErrorCodes.error_types))}
+
+# First byte of every (message type, error code) pair, already packed,
+# so single byte messages and headers don't need to be shifted and packed on every send.
+# Message types go from ParReq (0) to Conf (4).
+_FIRST_BYTE = {(msg_type, code): bytes(((msg_type << 4) | code,))
+               for msg_type in range(5) for code in range(len(ErrorCodes.error_types))}
+
 
 class Protocol:
     ParReq = 0
@@ -81,16 +126,19 @@ class Protocol:
         'DES': 3,
         '3DES-EDE2': 4,
         '3DES-EDE3': 5,
+        'CHACHA20': 6,
     }
 
-    code_to_alg = {
-        0: 'AES128',
-        1: 'AES192',
-        2: 'AES256',
-        3: 'DES',
-        4: '3DES-EDE2',
-        5: '3DES-EDE3',
-    }
+    # The codes are contiguous, so the code is the index (faster than a dict lookup)
+    code_to_alg = (
+        'AES128',     # 0
+        'AES192',     # 1
+        'AES256',     # 2
+        'DES',        # 3
+        '3DES-EDE2',  # 4
+        '3DES-EDE3',  # 5
+        'CHACHA20',   # 6
+    )
 
     mode_to_code = {
         'ECB': 0,
@@ -100,50 +148,148 @@ class Protocol:
         # 'CFB64': 4,
         # 'CFB128': 5,
         'CTR': 6,
+        'GCM': 7,
+        'POLY1305': 8,
     }
 
-    code_to_mode = {
-        0: 'ECB',
-        1: 'CBC',
-        # 2: 'CFB1',
-        3: 'CFB8',
-        # 4: 'CFB64',
-        # 5: 'CFB128',
-        6: 'CTR',
+    # Indexed by code, disabled modes are None
+    code_to_mode = (
+        'ECB',       # 0
+        'CBC',       # 1
+        None,        # 2 CFB1
+        'CFB8',      # 3
+        None,        # 4 CFB64
+        None,        # 5 CFB128
+        'CTR',       # 6
+        'GCM',       # 7
+        'POLY1305',  # 8
+    )
+
+    # Mode used when the algorithm is given without one. CTR is parallelizable and doesn't
+    # need padding, so it's preferred over the serial CBC. OpenSSL has no (Triple)DES in CTR,
+    # so those fall back to CBC, and CHACHA20 is only enabled with POLY1305.
+    default_mode = 'CTR'
+    default_mode_by_alg = {
+        'DES': 'CBC',
+        '3DES-EDE2': 'CBC',
+        '3DES-EDE3': 'CBC',
+        'CHACHA20': 'POLY1305',
     }
 
     def __init__(self, conn: socket.socket, key: bytes, source_id: int = None, dest_id: int = None, algorithm: str = None, pkcs5: bool = None, msg: bytes = None) -> None:
         self.conn: socket.socket = conn
         self.key: bytes = key
+
+        # Every receive goes through it, as it may buffer bytes of the following messages
+        self._receiver: networking.Receiver = networking.Receiver(conn)
         self.source_id: int = source_id
         self.dest_id: int = dest_id
 
         if algorithm is not None:
-            try:
-                alg, mode = algorithm.split(',')
-            except:
+            alg, *mode = algorithm.split(',')
+            if len(mode) > 1:
                 raise RuntimeError('algorithm bad formatted')
 
+            # The mode is optional, falling back to the preferred one for the algorithm
+            mode = mode[0] if mode else self.default_mode_by_alg.get(alg, self.default_mode)
+
             # Algorithm and mode strings
             self.algorithm: str = alg
             self.algorithm_mode: str = mode
 
             # Algorithm and mode codes
-
-            try:
-                self.algorithm_code: int = self.alg_to_code[alg]
-                self.algorithm_mode_code: int = self.mode_to_code[mode]
-            except:
+            self.algorithm_code: int = self.alg_to_code.get(alg)
+            self.algorithm_mode_code: int = self.mode_to_code.get(mode)
+            if self.algorithm_code is None or self.algorithm_mode_code is None:
                 raise RuntimeError('algorithm not supported')
 
         self.pkcs5: bool = pkcs5
         self.iv: bytes = b''
 
+        # Specialized for the negotiated parameters, then bound to the IV once it's known
+        self._bind: crypto.BindFunction = None
+        self._encrypt: crypto.CryptFunction = None
+        self._decrypt: crypto.CryptFunction = None
+        self._send_dados: typing.Callable[[bytes], None] = None
+        if algorithm is not None:
+            self.specialize_crypto()
+
+            # ParReq byte with the algorithm code on the high nibble and the padding on the low one,
+            # computed once as it doesn't change for the connection
+            self._alg_byte: int = self.algorithm_code << 4 | int(bool(pkcs5))
+
+        # Always set, so the message getter can tell it isn't ready yet
+        self._message: bytes = None
         if msg is not None:
             if len(msg) > 1440:
                 raise ErrorCodes(ErrorCodes.Internal)
 
-            self._message: bytes = msg
+            self._message = msg
+
+    """
+    Resolves the cipher functions once the algorithm, mode and padding are known,
+    so no name lookups are left for when the message is encrypted or decrypted.
+    """
+    def specialize_crypto(self) -> None:
+        # Parameters the key isn't suitable for (e.g. a wrong key size) are only reported when the
+        # message is encrypted or decrypted, so the negotiation still completes and the error
+        # travels in the Dados message like any other encryption error
+        try:
+            self._bind = crypto.specialize(self.key, self.algorithm, self.algorithm_mode, self.pkcs5)
+        except ErrorCodes as e:
+            self._bind = self.failing_bind(e)
+
+    """
+    Returns a bind function whose encrypt and decrypt functions raise the given error.
+    """
+    @staticmethod
+    def failing_bind(error: ErrorCodes) -> 'crypto.BindFunction':
+        def fail(data: bytes) -> bytes:
+            raise error
+
+        return lambda iv: (fail, fail)
+
+    """
+    Builds the encrypt and decrypt functions for the IV once it's known,
+    so the cipher isn't set up again for each message.
+    """
+    def bind_crypto(self) -> None:
+        try:
+            self._encrypt, self._decrypt = self._bind(self.iv)
+        except ErrorCodes:
+            raise
+        except Exception:
+            # e.g. a mode refusing the IV, reported like the other negotiation errors
+            raise ErrorCodes(ErrorCodes.Internal)
+
+        self._send_dados = self.make_send_dados()
+
+    """
+    Builds the function that encrypts and sends a Dados message for this connection.
+    Everything it needs is captured once, so sending doesn't look anything up on self.
+    """
+    def make_send_dados(self) -> typing.Callable[[bytes], None]:
+        # B unsigned char (1 byte)
+        # H unsigned short (2 bytes)
+        encrypt = self._encrypt
+        conn = self.conn
+        send_vec = networking.Connection.send_vec
+        pack_header = _DADOS_HDR.pack
+        ok_byte = self.Dados << 4 | ErrorCodes.OK
+        internal_byte = self.Dados << 4 | ErrorCodes.Internal
+
+        def send_dados(msg: bytes) -> None:
+            try:
+                payload: bytes = encrypt(msg)
+            except Exception:
+                # The peer is still told about the error, with an empty payload
+                send_vec(conn, (pack_header(internal_byte, 0),))
+                raise
+
+            # Header and payload are gathered in a single send, without copying the payload
+            send_vec(conn, (pack_header(ok_byte, len(payload)), payload))
+
+        return send_dados
 
     @property
     def message(self) -> bytes:
@@ -156,121 +302,117 @@ class Protocol:
     """
     def first_byte_check(self, expected_type: int) -> ErrorCodes:
         # Fetch a single byte
-        data = networking.Connection.receive(self.conn, 1)
+        data = self._receiver.receive(1)
 
-        eight_bits = byte_to_bitstring(data)
+        return self.first_byte_parse(data[0], expected_type)
 
-        if int(eight_bits[:4], base=2) != expected_type:
+    """
+    Checks if the type of an already received first byte is as expected, returning its error code
+    """
+    @staticmethod
+    def first_byte_parse(first_byte: int, expected_type: int) -> ErrorCodes:
+        # High nibble is the message type, low nibble is the error code
+        if first_byte >> 4 != expected_type:
             raise ErrorCodes(ErrorCodes.UnexpectedType)
 
-        error_code = int(eight_bits[4:], base=2)
-        return ErrorCodes(error_code)
+        return ErrorCodes.get(first_byte & 0x0F)
 
     def par_req_send(self) -> None:
         # B unsigned char (1 byte)
         # H unsigned short (2 bytes)
 
-        data: bytes = struct.pack('>BHHBB',
-                                  self.ParReq << 4 | ErrorCodes.OK,
-                                  self.source_id,
-                                  self.dest_id,
-                                  self.algorithm_code << 4 | self.pkcs5,
-                                  self.algorithm_mode_code)
+        data: bytes = _PARREQ.pack(self.ParReq << 4 | ErrorCodes.OK,
+                                   self.source_id,
+                                   self.dest_id,
+                                   self._alg_byte,
+                                   self.algorithm_mode_code)
 
         networking.Connection.send(self.conn, data)
 
     def par_req_recv(self) -> None:
-        error: ErrorCodes = self.first_byte_check(self.ParReq)
-        if error != ErrorCodes.OK:
+        # ParReq has a fixed size, so the whole message (header included) is fetched
+        # and unpacked at once (first nibble is the high one).
+        first_byte, self.source_id, self.dest_id, alg_padding, mode = _PARREQ.unpack(self._receiver.receive(_PARREQ.size))
+
+        if first_byte >> 4 != self.ParReq:
+            raise ErrorCodes(ErrorCodes.UnexpectedType)
+        if first_byte & 0x0F != ErrorCodes.OK:
             raise ErrorCodes(ErrorCodes.Internal)
 
-        data: bytes = networking.Connection.receive(self.conn, 6)
-        self.source_id = int.from_bytes(data[:2], 'big')
-        self.dest_id = int.from_bytes(data[2:4], 'big')
+        alg, padding, mode = self.params_parse(alg_padding, mode)
 
-        alg_padding = byte_to_bitstring(data[4:5])
-        alg = int(alg_padding[:4], base=2)
-        if alg not in self.code_to_alg:
-            raise ErrorCodes(ErrorCodes.NotSupportedParams)
         self.algorithm = self.code_to_alg[alg]
         self.algorithm_code = alg
+        self.pkcs5 = padding
+        self.algorithm_mode = self.code_to_mode[mode]
+        self.algorithm_mode_code = mode
 
-        padding = int(alg_padding[4:], base=2)
+        self.specialize_crypto()
+
+    """
+    Splits the algorithm and padding byte and checks it along with the mode byte,
+    returning the algorithm code, the padding and the mode code.
+    """
+    @classmethod
+    def params_parse(cls, alg_padding: int, mode: int) -> typing.Tuple[int, int, int]:
+        # High nibble is the algorithm, low nibble is the padding
+        alg = alg_padding >> 4
+        if alg >= len(cls.code_to_alg):
+            raise ErrorCodes(ErrorCodes.NotSupportedParams)
+
+        padding = alg_padding & 0x0F
         if padding not in [0, 1]:
             raise ErrorCodes(ErrorCodes.NotSupportedParams)
-        self.pkcs5 = padding
 
-        mode = int.from_bytes(data[5:6], 'big')
-        if mode not in self.code_to_mode:
+        if mode >= len(cls.code_to_mode) or cls.code_to_mode[mode] is None:
             raise ErrorCodes(ErrorCodes.NotSupportedParams)
 
-        self.algorithm_mode = self.code_to_mode[mode]
-        self.algorithm_mode_code = mode
+        return alg, padding, mode
 
     def par_conf_send(self) -> None:
-        # B unsigned char (1 byte)
         self.iv = os.urandom(16)
+        self.bind_crypto()
 
-        data: bytes = struct.pack('>B', self.ParConf << 4 | ErrorCodes.OK)
-        data += self.iv
+        # Header and IV are gathered in a single send, without copying them into one buffer
+        header: bytes = _FIRST_BYTE[(self.ParConf, ErrorCodes.OK)]
 
-        networking.Connection.send(self.conn, data)
+        networking.Connection.send_vec(self.conn, (header, self.iv))
 
     def par_conf_recv(self, error: ErrorCodes) -> None:
-        data: bytes = networking.Connection.receive(self.conn, 16)
+        data: bytes = self._receiver.receive(16)
         if error != ErrorCodes.OK:
             raise ErrorCodes(ErrorCodes.Internal)
 
         self.iv = data
 
-        if self.iv == b'0' * 16:
+        # Constant time compare, so checking the IV doesn't leak timing information about it
+        if hmac.compare_digest(self.iv, _NULL_IV):
             raise ErrorCodes(ErrorCodes.NullIV)
 
-    def dados_send(self) -> None:
-        # B unsigned char (1 byte)
-        # H unsigned short (2 bytes)
-
-        err = ErrorCodes.OK
-        err_obj = None
-        try:
-            payload: bytes = crypto.encrypt(self._message,
-                                            self.key,
-                                            self.iv,
-                                            self.algorithm,
-                                            self.algorithm_mode,
-                                            self.pkcs5)
-        except Exception as e:
-            payload = b''
-            err = ErrorCodes.Internal
-            err_obj = e
-
-        data: bytes = struct.pack('>BH',
-                                  self.Dados << 4 | err,
-                                  len(payload))
-        data += payload
+        self.bind_crypto()
 
-        networking.Connection.send(self.conn, data)
-
-        if err != ErrorCodes.OK:
-            raise err_obj
+    def dados_send(self) -> None:
+        # The whole message is encrypted with a single call before anything is sent: Dados carries
+        # the payload size up front and messages are at most 1440 bytes, so handing chunks to worker
+        # threads (to overlap encryption with the socket writes, or to split CTR blocks across CPUs)
+        # would cost more than it saves.
+        self._send_dados(self._message)
 
     def dados_recv(self) -> ErrorCodes:
-        error: ErrorCodes = self.first_byte_check(self.Dados)
+        # The first byte and the payload size are read at once, as the sender always sends both
+        first_byte, size = _DADOS_HDR.unpack(self._receiver.receive(_DADOS_HDR.size))
+
+        error: ErrorCodes = self.first_byte_parse(first_byte, self.Dados)
         if error != ErrorCodes.OK:
             return error
 
-        payload_size: int = int.from_bytes(networking.Connection.receive(self.conn, 2), 'big')
-        payload: bytes = networking.Connection.receive(self.conn, payload_size)
-
-        try:
-            self._message = crypto.decrypt(payload,
-                                           self.key,
-                                           self.iv,
-                                           self.algorithm,
-                                           self.algorithm_mode,
-                                           self.pkcs5)
-        except:
-            raise ErrorCodes(ErrorCodes.DataError)
+        # The payload is usually already buffered along with the header. It's decrypted
+        # straight from the receive buffer, without being copied out of it first.
+        with self._receiver.receive_view(size) as payload:
+            try:
+                self._message = self._decrypt(payload)
+            except:
+                raise ErrorCodes(ErrorCodes.DataError)
 
         return error
 
@@ -281,52 +423,48 @@ class Protocol:
         raise RuntimeError('not implemented')
 
     def lista_recv(self, error: ErrorCodes) -> typing.Tuple[ErrorCodes, list]:
-        payload_size: int = int.from_bytes(networking.Connection.receive(self.conn, 1), 'big')
-        payload: bytes = networking.Connection.receive(self.conn, payload_size)
+        _, payload = self._receiver.receive_framed(_BYTE)
 
         recv_list = []
 
-        for pos in range(len(payload) // 2):
-            i = pos * 2
+        # Each option takes 2 bytes, indexed straight as integers (a trailing odd byte is ignored)
+        for i in range(0, len(payload) - 1, 2):
+            alg, padding, mode = self.params_parse(payload[i], payload[i + 1])
 
-            opt = {}
-            alg_padding = byte_to_bitstring(payload[i:i+1])
-
-            alg = int(alg_padding[:4], base=2)
-            opt['algorithm'] = self.code_to_alg[alg]
-
-            padding = int(alg_padding[4:], base=2)
-            opt['padding'] = padding == 1
-
-            mode = int.from_bytes(payload[i+1:i+2], 'big')
-            opt['algorithm_mode'] = self.code_to_alg[mode]
-
-            recv_list.append(opt)
+            recv_list.append({
+                'algorithm': self.code_to_alg[alg],
+                'padding': padding == 1,
+                'algorithm_mode': self.code_to_mode[mode],
+            })
 
         return error, recv_list
 
     def conf_send(self, error: ErrorCodes) -> None:
-        # B unsigned char (1 byte)
-        data: bytes = struct.pack('>B', self.Conf << 4 | error.code)
+        data: bytes = _FIRST_BYTE[(self.Conf, error.code)]
         networking.Connection.send(self.conn, data)
 
     def conf_recv(self) -> ErrorCodes:
         return self.first_byte_check(self.Conf)
 
+    # Maps the message types accepted as a reply to ParReq to their receive methods.
+    # Built once with the class, so dispatching is a single dict lookup.
+    par_conf_OR_lista_dispatch = {
+        ParConf: par_conf_recv,
+        Lista: lista_recv,
+    }
+
     def par_conf_OR_lista_recv(self) -> typing.Any:
-        data = networking.Connection.receive(self.conn, 1)
+        data = self._receiver.receive(1)
 
-        eight_bits = byte_to_bitstring(data)
-        type_code = int(eight_bits[:4], base=2)
-        error_code = int(eight_bits[4:], base=2)
-        error = ErrorCodes(error_code)
+        # High nibble is the message type, low nibble is the error code
+        type_code = data[0] >> 4
+        error_code = data[0] & 0x0F
 
-        if type_code == self.ParConf:
-            return self.par_conf_recv(error)
-        elif type_code == self.Lista:
-            return self.lista_recv(error)
+        recv = self.par_conf_OR_lista_dispatch.get(type_code)
+        if recv is None:
+            raise ErrorCodes(ErrorCodes.UnexpectedType)
 
-        raise ErrorCodes(ErrorCodes.UnexpectedType)
+        return recv(self, ErrorCodes.get(error_code))
 
 
 class Receive(Protocol):
@@ -337,10 +475,14 @@ class Receive(Protocol):
         try:
             self.par_req_recv()
         except ErrorCodes as e:
-            self.conf_send(ErrorCodes(ErrorCodes.Internal))
+            self.conf_send(ErrorCodes.get(ErrorCodes.Internal))
             raise e
 
-        self.par_conf_send()
+        try:
+            self.par_conf_send()
+        except ErrorCodes as e:
+            self.conf_send(ErrorCodes.get(ErrorCodes.Internal))
+            raise e
 
         try:
             err = self.dados_recv()
@@ -349,9 +491,9 @@ class Receive(Protocol):
             raise e
 
         if err != ErrorCodes.OK:
-            raise err
+            raise ErrorCodes(err.code)
 
-        self.conf_send(ErrorCodes(ErrorCodes.OK))
+        self.conf_send(ErrorCodes.get(ErrorCodes.OK))
 
 
 class Send(Protocol):
@@ -364,17 +506,17 @@ class Send(Protocol):
         try:
             ret = self.par_conf_OR_lista_recv()
             if ret is not None:  # Message of type Lista received
-                raise ret[0]
+                raise ErrorCodes(ret[0].code)
         except ErrorCodes as e:
-            self.conf_send(ErrorCodes(ErrorCodes.Internal))
+            self.conf_send(ErrorCodes.get(ErrorCodes.Internal))
             raise e
 
         try:
             self.dados_send()
         except ErrorCodes as e:
-            self.conf_send(ErrorCodes(ErrorCodes.Internal))
+            self.conf_send(ErrorCodes.get(ErrorCodes.Internal))
             raise e
 
         err = self.conf_recv()
         if err != ErrorCodes.OK:
-            raise err
+            raise ErrorCodes(err.code)